@@ -0,0 +1,260 @@
+'''
+Benchmarks for the physics, collision, render and ranking paths of main.py
+
+Renders with software GL (Mesa llvmpipe) by default.  GLUT needs a display,
+so on headless machines run the draw benchmarks under Xvfb:
+
+  xvfb-run -a python benchmarks/benchmark.py --output benchmarks/baseline.json
+  xvfb-run -a python benchmarks/benchmark.py --compare benchmarks/baseline.json
+
+When no draw benchmark is selected (e.g. --filter integrator) the window is
+created headless and GLUT is not initialised, so no display is needed.
+
+--compare exits with status 1 when a benchmark is slower than the baseline
+by more than --threshold.
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+BENCHMARK_REPEAT = 5
+BENCHMARK_MIN_TIME = 0.2
+BATCH_SIZE = 1000
+RANKING_SIZES = [10**3, 10**4, 10**5, 10**6]
+REGRESSION_THRESHOLD = 0.2
+
+benchmarks = []
+
+def benchmark(name, unit='us', higher_is_better=False):
+  def register(func):
+    benchmarks.append((name, unit, higher_is_better, func))
+    return func
+  return register
+
+def time_per_call(func, repeat=BENCHMARK_REPEAT, min_time=BENCHMARK_MIN_TIME):
+  # best of `repeat` runs, each calling func until min_time has elapsed
+  best = float('inf')
+  for _ in range(repeat):
+    number = 0
+    start = time.perf_counter()
+    while True:
+      func()
+      number += 1
+      elapsed = time.perf_counter()-start
+      if elapsed >= min_time:
+        break
+    best = min(best, elapsed/number)
+  return best
+
+def time_draw(draw):
+  # glFinish makes the GPU (or llvmpipe) work part of the measured time
+  def func():
+    draw()
+    game.glFinish()
+  return time_per_call(func)
+
+# --------------------------------------------------------------------------
+# Physics
+# --------------------------------------------------------------------------
+
+def new_electron_ionized():
+  return game.Electron_ionized(game.ELECTRON_SIZE,
+                               game.ELECTRON_INITIAL_POSITION,
+                               game.ELECTRON_INITIAL_VELOCITY,
+                               game.ELECTRON_DRAW_PARAMS)
+
+@benchmark('integrator_single', unit='steps/s', higher_is_better=True)
+def bench_integrator_single():
+  electron = new_electron_ionized()
+  dt = game.TIME_SCALE_FACTOR/60
+  return 1/time_per_call(lambda: electron.update(dt, [0, 0]))
+
+@benchmark('integrator_batched', unit='steps/s', higher_is_better=True)
+def bench_integrator_batched():
+  # there is no vectorized integrator for ionized electrons, so a batch is stepped one by one
+  electrons = [new_electron_ionized() for _ in range(BATCH_SIZE)]
+  dt = game.TIME_SCALE_FACTOR/60
+  def step():
+    for electron in electrons:
+      electron.update(dt, [0, 0])
+  return BATCH_SIZE/time_per_call(step)
+
+@benchmark('bound_propagator_batched', unit='steps/s', higher_is_better=True)
+def bench_bound_propagator_batched():
+  rng = np.random.default_rng(0)
+  r = rng.uniform(0.5, 1.5, BATCH_SIZE)*game.ATOM_RADIUS
+  angle = rng.uniform(-np.pi, np.pi, BATCH_SIZE)
+  speed = rng.uniform(0.7, 1.2, BATCH_SIZE)/np.sqrt(r)
+  positions = np.c_[r*np.cos(angle), r*np.sin(angle), np.zeros(BATCH_SIZE)]
+  velocities = np.c_[-speed*np.sin(angle), speed*np.cos(angle), np.zeros(BATCH_SIZE)]
+  electrons = game.Bound_electrons(game.ELECTRON_SIZE, positions, velocities, game.ELECTRON_DRAW_PARAMS)
+  dt = game.TIME_SCALE_FACTOR/60
+  return BATCH_SIZE/time_per_call(lambda: electrons.update(dt))
+
+@benchmark('check_collision')
+def bench_check_collision():
+  game.init_objects()
+  return 1e6*time_per_call(game.check_collision)
+
+@benchmark('check_gameover')
+def bench_check_gameover():
+  game.init_objects()
+  return 1e6*time_per_call(game.check_gameover)
+
+# --------------------------------------------------------------------------
+# Rendering
+# --------------------------------------------------------------------------
+
+VIEWS = {'start': lambda: game.MenuState(), 'game': lambda: game.InGameState()}
+
+def prepare_view(new_state):
+  # the state is assigned without entering it, so no handlers or transitions are set up
+  game.state = new_state()
+  game.glClear(game.GL_COLOR_BUFFER_BIT | game.GL_DEPTH_BUFFER_BIT)
+  game.glLoadIdentity()
+  game.gl_set_viewpoint()
+  game.glLightfv(game.GL_LIGHT0, game.GL_POSITION, [5.0, 5.0, 5.0, 0.0])
+
+def draw_benchmarks(name, get_object):
+  for view, new_state in VIEWS.items():
+    def bench(view=view, new_state=new_state):
+      game.init_objects()
+      game.electron_ionized.position_cache = [[game.ATOM_RADIUS*np.cos(0.1*i), game.ATOM_RADIUS*np.sin(0.1*i), 0]
+                                              for i in range(game.ELECTRON_CACHE_NUM)]
+      game.light_cone.is_active = True
+      game.score = game.LIGHT_CONE_COLOR_MAX_ENERGY/2
+      prepare_view(new_state)
+      return 1e6*time_draw(get_object().draw)
+    benchmark('draw_%s_%s' % (name, view))(bench)
+
+draw_benchmarks('mesh', lambda: game.mesh)
+draw_benchmarks('light_cone', lambda: game.light_cone)
+draw_benchmarks('trail', lambda: game.electron_ionized)
+draw_benchmarks('nuclear', lambda: game.nuclear)
+
+def overlay_benchmark(name, new_overlay):
+  @benchmark('draw_overlay_%s' % name)
+  def bench():
+    overlay = new_overlay()
+    def draw():
+      game.gl_prepare_for_2D()
+      overlay.draw()
+      game.gl_prepare_for_3D()
+    return 1e6*time_draw(draw)
+
+overlay_benchmark('start_menu', lambda: game.StartMenu())
+overlay_benchmark('gameover', lambda: game.GameOver())
+overlay_benchmark('cleared', lambda: game.Cleared(game.LIGHT_CONE_COLOR_MAX_ENERGY))
+
+# --------------------------------------------------------------------------
+# Ranking
+# --------------------------------------------------------------------------
+
+def write_ranking(filename, size):
+  rng = np.random.default_rng(0)
+  pd.DataFrame({'name': ['player%d' % i for i in range(size)],
+                'score': rng.uniform(0, 100, size)}).to_csv(filename, index=False)
+
+def ranking_benchmarks(size):
+  @benchmark('ranking_load_%d' % size)
+  def bench_load():
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, 'ranking.csv')
+      write_ranking(filename, size)
+      return 1e6*time_per_call(lambda: game.load_ranking(filename), repeat=3, min_time=0)
+
+  @benchmark('ranking_insert_%d' % size)
+  def bench_insert():
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, 'ranking.csv')
+      write_ranking(filename, size)
+      ranking_data = game.load_ranking(filename)
+      return 1e6*time_per_call(lambda: game.save_ranking(ranking_data, 'you', 50, filename), repeat=3, min_time=0)
+
+for size in RANKING_SIZES:
+  ranking_benchmarks(size)
+
+# --------------------------------------------------------------------------
+# Run and compare
+# --------------------------------------------------------------------------
+
+def select_benchmarks(name_filter=None):
+  return [b for b in benchmarks if not name_filter or name_filter in b[0]]
+
+def run_benchmarks(selected):
+  results = {}
+  for name, unit, higher_is_better, func in selected:
+    value = func()
+    results[name] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+    print('%-32s %14.2f %s' % (name, value, unit))
+  return results
+
+def compare(results, baseline, threshold):
+  # returns the names of benchmarks that got worse than the baseline by more than threshold
+  regressions = []
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    base = baseline[name]['value']
+    if result['higher_is_better']:
+      change = base/result['value']-1
+    else:
+      change = result['value']/base-1
+    is_regression = change > threshold
+    if is_regression:
+      regressions.append(name)
+    print('%-32s %14.2f -> %14.2f %s  %+6.1f%%%s' % (name, base, result['value'], result['unit'],
+                                                   100*change, '  REGRESSION' if is_regression else ''))
+  return regressions
+
+def run():
+  global game
+  parser = argparse.ArgumentParser(description='Benchmark the HHG game.')
+  parser.add_argument('--output', help='write results as JSON to this file')
+  parser.add_argument('--compare', help='baseline JSON to compare the results against')
+  parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                      help='relative slowdown reported as a regression (default %(default)s)')
+  parser.add_argument('--filter', help='only run benchmarks whose name contains this string')
+  parser.add_argument('--hardware', action='store_true', help='use hardware GL instead of software rendering')
+  args = parser.parse_args()
+
+  selected = select_benchmarks(args.filter)
+  needs_gl = any(name.startswith('draw_') for name, _, _, _ in selected)
+  if not args.hardware:
+    os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+  if not needs_gl:
+    import pyglet
+    pyglet.options['headless'] = True
+  import main as game
+  if needs_gl:
+    game.glutInit()
+    game.init_gl()
+    game.on_resize(game.win.width, game.win.height)
+
+  results = run_benchmarks(selected)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'platform': platform.platform(),
+                 'python': platform.python_version(),
+                 'renderer': game.glGetString(game.GL_RENDERER).decode() if needs_gl else None,
+                 'results': results}, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)['results']
+    print()
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+      print('\n%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+      sys.exit(1)
+
+if __name__ == '__main__':
+  run()
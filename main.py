@@ -1,6 +1,8 @@
 '''
 HHG GAME
 '''
+import inspect
+import math
 import numpy as np
 import pandas as pd
 import os
@@ -10,6 +12,8 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 
+from trajectory import TrajectoryRecorder
+
 WINDOW_WIDTH  = 1300
 WINDOW_HEIGHT = 800
 
@@ -31,7 +35,8 @@ ELECTRON_SIZE = 1
 NUCLEAR_SIZE = 1.5
 ELECTRON_INITIAL_POSITION = [ATOM_RADIUS, 0, 0]
 ELECTRON_INITIAL_VELOCITY = [0, 1/np.sqrt(ATOM_RADIUS), 0]
-ELECTRON_ANGULAR_FREQUENCY = 1/np.sqrt(ATOM_RADIUS)**3
+KEPLER_ITERATIONS = 6
+KEPLER_CIRCULAR_ECCENTRICITY = 1e-9
 ELECTRON_CACHE_NUM = 30
 LIGHT_CONE_SLICES = 50
 LIGHT_CONE_STACKS = 10
@@ -51,6 +56,7 @@ ELECTRIC_FIELD_WINDOW_FRACTION = 0.1
 
 FONT_NAME = 'Osaka'
 RANKING_FILENAME = 'tmp/ranking.csv'
+TRAJECTORY_DIRECTORY = None # e.g. 'tmp/trajectory' to record every game for offline analysis
 
 MENU_TITLE_SIZE = 36
 MENU_TITLE_POSITION = WINDOW_HEIGHT/8
@@ -59,6 +65,7 @@ MENU_ITEM_INTERVAL = WINDOW_HEIGHT/15
 
 START_GAME_DELAY = 1
 CLEAR_DELAY = 2
+GAME_TICK_INTERVAL = 1/60.
 
 VIEW_START_X = 0
 VIEW_START_Y = 50
@@ -68,6 +75,17 @@ VIEW_GAME_X = 0
 VIEW_GAME_Y = 0
 VIEW_GAME_Z = 150
 
+VIEW_UP = [0, -1, 0]
+FIELD_OF_VIEW = 45
+NEAR_CLIP = 0.1
+FAR_CLIP = 1000
+
+LOD_MAX_ERROR_PIXELS = 0.5
+LOD_MAX_FAINT_ERROR_PIXELS = 1
+LOD_FULL_DETAIL_RADIUS_PIXELS = 8
+LOD_MIN_SLICES = 6
+LOD_MIN_STACKS = 3
+
 
 # --------------------------------------------------------------------------
 # Game objects
@@ -81,12 +99,19 @@ class Particle:
     self.draw_params = draw_params
 
   def draw(self):
+    self.draw_sphere(self.x, self.y, self.z)
+
+  def draw_sphere(self, x, y, z):
+    position = [x, y, z]
+    if not is_sphere_visible(position, self.size):
+      return
+    slices, stacks = lod_tessellation(position, self.size, self.draw_params['slices'], self.draw_params['stacks'])
     glPushMatrix()
-    glTranslated(self.x, self.y, self.z)
+    glTranslated(x, y, z)
     glMaterialfv(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE, self.draw_params['diffuse'])
     glMaterialfv(GL_FRONT_AND_BACK, GL_SPECULAR, self.draw_params['specular'])
     glMaterialfv(GL_FRONT_AND_BACK, GL_SHININESS, self.draw_params['shininess'])
-    glutSolidSphere(self.size, self.draw_params['slices'], self.draw_params['stacks'])
+    glutSolidSphere(self.size, slices, stacks)
     glPopMatrix()
 
   def update(self):
@@ -112,6 +137,13 @@ class Electron_ionized(Particle):
       for i, p in enumerate(self.position_cache):
         if i%2 == 0:
           attenuation = np.exp(-(1-(i+1)/len(self.position_cache)))
+          size = self.size*attenuation
+          if not is_sphere_visible(p, size):
+            continue
+          slices, stacks = lod_tessellation(p, size,
+                                            self.draw_params['slices'],
+                                            int(self.draw_params['stacks']*attenuation),
+                                            attenuation**2)
           glPushMatrix()
           glTranslated(p[0], p[1], p[2])
           diffuse = self.draw_params['diffuse']
@@ -122,8 +154,9 @@ class Electron_ionized(Particle):
           glMaterialfv(GL_FRONT_AND_BACK, GL_SHININESS, self.draw_params['shininess'])
           if i == len(self.position_cache)-2:
             glDisable(GL_BLEND)
-          glutSolidSphere(self.size*attenuation, self.draw_params['slices'], int(self.draw_params['stacks']*attenuation))
+          glutSolidSphere(size, slices, stacks)
           glPopMatrix()
+      glDisable(GL_BLEND)
 
   def __coulomb_force_xy(self, x, y):
     return -x/np.sqrt(x**2+y**2)**3
@@ -150,22 +183,102 @@ class Electron_ionized(Particle):
     self.vx += (kvx1+2*kvx2+2*kvx3+kvx4)/6
     self.vy += (kvy1+2*kvy2+2*kvy3+kvy4)/6
 
-class Electron_localized(Particle):
-  def __init__(self, size, position, velocity, draw_params):
-    super().__init__(size, position, draw_params)
-    self.vx, self.vy, self.vz = velocity
-    if self.x == 0:
-      self.angle0 = np.pi/2 if self.y > 0 else -np.pi/2
-    else:
-      self.angle0 = np.arctan(self.y/self.x)
-    self.r = np.sqrt(self.x**2+self.y**2)
+def kepler_state(a, e, b, cos_omega, sin_omega, mean_anomaly0, mean_motion, t, is_circular=False, xp=np):
+  # position and velocity on Kepler orbits at time t; works on arrays (xp=np) or on floats (xp=math)
+  mean_anomaly = (mean_anomaly0+mean_motion*t)%(2*np.pi)
+  if is_circular:
+    eccentric_anomaly = mean_anomaly
+  else:
+    eccentric_anomaly = mean_anomaly+xp.copysign(0.85*e, xp.sin(mean_anomaly))
+    for _ in range(KEPLER_ITERATIONS):
+      eccentric_anomaly = eccentric_anomaly-((eccentric_anomaly-e*xp.sin(eccentric_anomaly)-mean_anomaly)
+                                             /(1-e*xp.cos(eccentric_anomaly)))
+  cos_E = xp.cos(eccentric_anomaly)
+  sin_E = xp.sin(eccentric_anomaly)
+  k = a*mean_motion/(1-e*cos_E)
+  x = a*(cos_E-e)
+  y = a*b*sin_E
+  vx = -k*sin_E
+  vy = k*b*cos_E
+  return (cos_omega*x-sin_omega*y, sin_omega*x+cos_omega*y,
+          cos_omega*vx-sin_omega*vy, sin_omega*vx+cos_omega*vy)
+
+class Bound_electrons(Particle):
+  ELEMENTS = ['a', 'e', 'b', 'cos_omega', 'sin_omega', 'mean_anomaly0', 'mean_motion']
+
+  def __init__(self, size, positions, velocities, draw_params):
+    # positions and velocities are lists of [x, y, z]; each electron moves analytically
+    # on the Kepler orbit (in the xy plane) through its initial state
+    positions = np.array(positions, dtype=float)
+    velocities = np.array(velocities, dtype=float)
+    super().__init__(size, positions.T, draw_params)
+    self.vx, self.vy, self.vz = velocities.T
+    self.__set_orbital_elements(self.x, self.y, self.vx, self.vy)
     self.t = 0
 
   def update(self, dt):
-    self.x = self.r*np.cos(ELECTRON_ANGULAR_FREQUENCY*self.t+self.angle0)
-    self.y = self.r*np.sin(ELECTRON_ANGULAR_FREQUENCY*self.t+self.angle0)
+    self.__propagate(self.t)
     self.t += dt
 
+  def draw(self):
+    for x, y, z in zip(self.x, self.y, self.z):
+      self.draw_sphere(x, y, z)
+
+  def ionize(self, i):
+    # removes electron i from the ensemble and returns it as a numerically integrated electron
+    electron = Electron_ionized(self.size,
+                                [float(self.x[i]), float(self.y[i]), float(self.z[i])],
+                                [float(self.vx[i]), float(self.vy[i]), float(self.vz[i])],
+                                self.draw_params)
+    for name in ['x', 'y', 'z', 'vx', 'vy', 'vz']+self.ELEMENTS:
+      setattr(self, name, np.delete(getattr(self, name), i))
+    self.__cache_elements()
+    return electron
+
+  def __set_orbital_elements(self, x, y, vx, vy):
+    r = np.sqrt(x**2+y**2)
+    v2 = vx**2+vy**2
+    angular_momentum = x*vy-y*vx
+    # unbound (v**2 >= 2/r) and radial (zero angular momentum) orbits both have e >= 1
+    if np.any(v2 >= 2/r) or np.any(angular_momentum == 0):
+      raise ValueError('Bound_electrons needs bound, non-radial orbits (v**2 < 2/r and x*vy-y*vx != 0)')
+    rv = x*vx+y*vy
+    direction = np.where(angular_momentum < 0, -1.0, 1.0)
+    self.a = 1/(2/r-v2)
+    ex = (v2-1/r)*x-rv*vx
+    ey = (v2-1/r)*y-rv*vy
+    self.e = np.sqrt(ex**2+ey**2)
+    self.b = direction*np.sqrt(1-self.e**2)
+    omega = np.where(self.e > 1e-12, np.arctan2(ey, ex), 0)
+    self.cos_omega = np.cos(omega)
+    self.sin_omega = np.sin(omega)
+    true_anomaly = direction*(np.arctan2(y, x)-omega)
+    eccentric_anomaly = 2*np.arctan2(np.sqrt(1-self.e)*np.sin(true_anomaly/2),
+                                     np.sqrt(1+self.e)*np.cos(true_anomaly/2))
+    self.mean_anomaly0 = eccentric_anomaly-self.e*np.sin(eccentric_anomaly)
+    self.mean_motion = self.a**-1.5
+    self.__cache_elements()
+
+  def __cache_elements(self):
+    # a single electron is propagated on floats with math, which is much cheaper than 1-element arrays
+    self.is_circular = bool(np.all(self.e < KEPLER_CIRCULAR_ECCENTRICITY))
+    if self.e.size == 1:
+      self.single_elements = [float(getattr(self, name)[0]) for name in self.ELEMENTS]
+    else:
+      self.single_elements = None
+
+  def __propagate(self, t):
+    if self.single_elements:
+      self.x[0], self.y[0], self.vx[0], self.vy[0] = kepler_state(*self.single_elements, t,
+                                                                  self.is_circular, math)
+    else:
+      self.x, self.y, self.vx, self.vy = kepler_state(*[getattr(self, name) for name in self.ELEMENTS], t,
+                                                      self.is_circular)
+
+class Electron_localized(Bound_electrons):
+  def __init__(self, size, position, velocity, draw_params):
+    super().__init__(size, [position], [velocity], draw_params)
+
 class Electric_field:
   def __init__(self):
     self.ex = 0
@@ -194,6 +307,10 @@ class LightCone:
       glLightfv(GL_LIGHT1, GL_SPECULAR, [50.0, 50.0, 50.0, 10.0])
       glLightfv(GL_LIGHT1, GL_POSITION, [0.0, 0.0, 5.0, 1.0])
       for axis in [-1, 1]:
+        bottom_center = [-axis*LIGHT_CONE_HEIGHT*np.cos(np.radians(self.angle)),
+                         -axis*LIGHT_CONE_HEIGHT*np.sin(np.radians(self.angle)),
+                         0]
+        slices, _ = lod_tessellation(bottom_center, LIGHT_CONE_BOTTOM, LIGHT_CONE_SLICES, LIGHT_CONE_STACKS)
         glPushMatrix()
         glRotated(self.angle, 0, 0, 1)
         glRotated(90, 0, axis, 0)
@@ -203,7 +320,7 @@ class LightCone:
         glMaterialfv(GL_FRONT_AND_BACK, GL_SHININESS, 50)
         glutSolidCone(LIGHT_CONE_BOTTOM,
                       LIGHT_CONE_HEIGHT,
-                      LIGHT_CONE_SLICES,
+                      slices,
                       LIGHT_CONE_STACKS)
         glPopMatrix()
       glDisable(GL_LIGHT1)
@@ -316,8 +433,8 @@ class Cleared(TextList):
 class Ranking(TextList):
   def __init__(self):
     super().__init__('ランキング', show_start_menu)
-    if os.path.exists(RANKING_FILENAME):
-      ranking_data = pd.read_csv(RANKING_FILENAME).sort_values(by='score', ascending=False)
+    ranking_data = load_ranking()
+    if ranking_data is not None:
       for i in range(min(5, ranking_data.index.size)):
         self.append_label('%d位: %s さん  %d eV' % (i+1, ranking_data.iloc[i]['name'], ranking_data.iloc[i]['score']))
     else:
@@ -369,12 +486,7 @@ class InputName(Overlay):
     if symbol == pyglet.window.key.ENTER:
       global ranking_data, score
       self.name = self.name.rstrip()
-      current_data = pd.DataFrame([self.name, score]).T.rename(columns={0: 'name', 1: 'score'})
-      if ranking_data is not None:
-        appended_ranking_data = ranking_data.append(current_data)
-      else:
-        appended_ranking_data = current_data
-      appended_ranking_data.to_csv(RANKING_FILENAME, index=False)
+      save_ranking(ranking_data, self.name, score)
       show_start_menu()
     elif symbol == pyglet.window.key.BACKSPACE:
       if len(self.name) > 0:
@@ -471,6 +583,110 @@ class InGameEventHandler(object):
       electric_field.ex = ELECTRIC_FIELD_SCALE_FACTOR*(x-WINDOW_WIDTH/2)
       electric_field.ey = ELECTRIC_FIELD_SCALE_FACTOR*(y-WINDOW_HEIGHT/2)/WINDOW_HEIGHT*WINDOW_WIDTH
 
+# --------------------------------------------------------------------------
+# Game states
+# --------------------------------------------------------------------------
+
+class GameState:
+  # tick_interval None means no periodic update: physics is paused and
+  # the window is redrawn only on input or on a scheduled transition
+  tick_interval = GAME_TICK_INTERVAL
+
+  def __init__(self, overlay=None):
+    self.overlay = overlay
+    self.t = 0
+
+  def enter(self):
+    pass
+
+  def exit(self):
+    pass
+
+  def update(self, dt):
+    self.t += dt
+    update_physics(dt*TIME_SCALE_FACTOR)
+
+  def draw(self):
+    pass
+
+  def viewpoint(self):
+    return VIEW_START_X, VIEW_START_Y, VIEW_START_Z
+
+  def clear_color(self):
+    return [0, 0, 0, 0]
+
+class MenuState(GameState):
+  tick_interval = None
+
+  def update(self, dt):
+    pass
+
+class GameOverState(MenuState):
+  def viewpoint(self):
+    return VIEW_GAME_X, VIEW_GAME_Y, VIEW_GAME_Z
+
+class StartTransitionState(GameState):
+  def enter(self):
+    schedule_transition(start_game, START_GAME_DELAY)
+
+  def viewpoint(self):
+    x = (VIEW_START_X-VIEW_GAME_X)*np.exp(-0.05*np.abs(VIEW_GAME_X-VIEW_START_X)*self.t/START_GAME_DELAY)+VIEW_GAME_X
+    y = (VIEW_START_Y-VIEW_GAME_Y)*np.exp(-0.05*np.abs(VIEW_GAME_Y-VIEW_START_Y)*self.t/START_GAME_DELAY)+VIEW_GAME_Y
+    z = (VIEW_START_Z-VIEW_GAME_Z)*np.exp(-0.05*np.abs(VIEW_GAME_Z-VIEW_START_Z)*self.t/START_GAME_DELAY)+VIEW_GAME_Z
+    return x, y, z
+
+class InGameState(GameState):
+  def enter(self):
+    global is_ionized
+    is_ionized = False
+    self.event_handler = InGameEventHandler()
+    win.push_handlers(self.event_handler)
+    if trajectory_recorder:
+      trajectory_recorder.start_session()
+
+  def exit(self):
+    win.remove_handlers(self.event_handler)
+    if trajectory_recorder:
+      trajectory_recorder.flush()
+
+  def update(self, dt):
+    # a check that ends the game leaves this state; nothing more is done for it then
+    check_gameover()
+    if state is not self:
+      return
+    check_collision()
+    if state is not self:
+      return
+    super().update(dt)
+    if trajectory_recorder:
+      trajectory_recorder.record(self.t*TIME_SCALE_FACTOR, electron_ionized.x, electron_ionized.y,
+                                 electron_ionized.vx, electron_ionized.vy,
+                                 electric_field.ex, electric_field.ey)
+
+  def draw(self):
+    electric_field.draw()
+
+  def viewpoint(self):
+    return VIEW_GAME_X, VIEW_GAME_Y, VIEW_GAME_Z
+
+class ClearTransitionState(GameState):
+  def enter(self):
+    schedule_transition(cleared, CLEAR_DELAY)
+
+  def viewpoint(self):
+    if self.t < 0.5*CLEAR_DELAY:
+      return VIEW_GAME_X, VIEW_GAME_Y, VIEW_GAME_Z
+    t = self.t-0.5*CLEAR_DELAY
+    x = (VIEW_GAME_X-VIEW_START_X)*np.exp(-0.1*np.abs(VIEW_START_X-VIEW_GAME_X)*t/CLEAR_DELAY)+VIEW_START_X
+    y = (VIEW_GAME_Y-VIEW_START_Y)*np.exp(-0.1*np.abs(VIEW_START_Y-VIEW_GAME_Y)*t/CLEAR_DELAY)+VIEW_START_Y
+    z = (VIEW_GAME_Z-VIEW_START_Z)*np.exp(-0.1*np.abs(VIEW_START_Z-VIEW_GAME_Z)*t/CLEAR_DELAY)+VIEW_START_Z
+    return x, y, z
+
+  def clear_color(self):
+    factor = min(LIGHT_FLASH_MAX_ENERGY, score)/LIGHT_FLASH_MAX_ENERGY
+    light_enhancement = factor*np.exp(-(self.t/CLEAR_DELAY)*5)
+    return [light_enhancement]*4
+
 # --------------------------------------------------------------------------
 # Game state functions
 # --------------------------------------------------------------------------
@@ -492,86 +708,93 @@ def set_overlay(new_overlay):
   if overlay:
     win.push_handlers(overlay)
 
+def set_state(new_state):
+  global state
+  pyglet.clock.unschedule(update)
+  if pending_transition:
+    pyglet.clock.unschedule(pending_transition)
+  if state:
+    state.exit()
+  state = new_state
+  set_overlay(state.overlay)
+  state.enter()
+  if state.tick_interval:
+    pyglet.clock.schedule_interval(update, state.tick_interval)
+  request_redraw()
+
+def schedule_transition(transition, delay):
+  # transition is cancelled if the state changes before delay has passed
+  global pending_transition
+  def invoke(dt):
+    global pending_transition
+    pending_transition = None
+    transition()
+  pending_transition = invoke
+  pyglet.clock.schedule_once(pending_transition, delay)
+
 def start_game_transition():
-  global in_start_menu, in_transition_from_start_menu_to_game, t_transition
-  set_overlay(None)
-  in_start_menu = False
-  in_transition_from_start_menu_to_game = True
-  t_transition = 0
-  pyglet.clock.schedule_once(start_game, START_GAME_DELAY)
+  set_state(StartTransitionState())
 
 def start_tutorial_transition():
-  in_tutorial = True
   start_game_transition()
 
-
-def start_game(dt):
-  global in_transition_from_start_menu_to_game, in_game_event_handler, in_game
-  in_game_event_handler = InGameEventHandler()
-  set_overlay(None)
-  win.push_handlers(in_game_event_handler)
-  in_transition_from_start_menu_to_game = False
-  in_game = True
+def start_game():
+  set_state(InGameState())
 
 def show_ranking():
- set_overlay(Ranking())
+  set_state(MenuState(Ranking()))
 
 def check_gameover():
-  global electron_ionized, in_game, is_gameover, is_ionized
+  global is_ionized
   if np.abs(electron_ionized.x) > X_MAX or np.abs(electron_ionized.y) > Y_MAX:
-    in_game = False
     is_ionized = False
-    is_gameover = True
-    win.remove_handlers(in_game_event_handler)
-    set_overlay(GameOver())
+    set_state(GameOverState(GameOver()))
 
 def check_collision():
-  global electron_ionized, in_game, is_cleared, is_ionized, score, light_cone
+  global is_ionized, score
   r = np.sqrt(electron_ionized.x**2+electron_ionized.y**2)
-  if (not is_ionized) and (r > IONIZATION_RADIUS) and (not is_gameover):
+  if (not is_ionized) and (r > IONIZATION_RADIUS):
     is_ionized = True
   if is_ionized and r < ATOM_RADIUS:
     energy = np.sqrt(electron_ionized.vx**2+electron_ionized.vy**2)/2
     score = energy*RYDBERG
-    in_game = False
     is_ionized = False
     electron_ionized.is_active = False
     light_cone.is_active = True
     light_cone.angle = 180/np.pi*np.arctan(-electron_ionized.vx/electron_ionized.vy)
-    win.remove_handlers(in_game_event_handler)
     clear_transition()
 
 def clear_transition():
-  global in_transition_from_game_to_cleared, t_transition
-  set_overlay(None)
-  in_transition_from_game_to_cleared = True
-  t_transition = 0
-  pyglet.clock.schedule_once(cleared, CLEAR_DELAY)
-
-def cleared(dt):
-  global in_transition_from_game_to_cleared, is_cleared
-  in_transition_from_game_to_cleared = False
-  is_cleared = True
-  set_overlay(Cleared(score))
+  set_state(ClearTransitionState())
+
+def cleared():
+  set_state(MenuState(Cleared(score)))
 
 def show_ranking_after_clear():
-  global ranking_data, is_cleared
-  is_cleared = False
-  if os.path.exists(RANKING_FILENAME):
-    ranking_data = pd.read_csv(RANKING_FILENAME).sort_values(by='score', ascending=False)
+  global ranking_data
+  ranking_data = load_ranking()
+  set_state(MenuState(RankingAfterClear()))
+
+def load_ranking(filename=RANKING_FILENAME):
+  if os.path.exists(filename):
+    return pd.read_csv(filename).sort_values(by='score', ascending=False)
   else:
-    ranking_data = None
-  set_overlay(RankingAfterClear())
+    return None
+
+def save_ranking(ranking_data, name, score, filename=RANKING_FILENAME):
+  current_data = pd.DataFrame([name, score]).T.rename(columns={0: 'name', 1: 'score'})
+  if ranking_data is not None:
+    appended_ranking_data = pd.concat([ranking_data, current_data])
+  else:
+    appended_ranking_data = current_data
+  appended_ranking_data.to_csv(filename, index=False)
 
 def input_name_for_ranking():
-  set_overlay(InputName())
+  set_state(MenuState(InputName()))
 
 def show_start_menu():
-  global is_gameover, in_start_menu
-  is_gameover = False
-  in_start_menu = True
-  set_overlay(StartMenu())
   init_objects()
+  set_state(MenuState(StartMenu()))
 
 # --------------------------------------------------------------------------
 # OpenGL functions
@@ -605,33 +828,69 @@ def gl_prepare_for_3D():
   glPopMatrix()
 
 def gl_clear_color_setting():
-  global score
-  if in_transition_from_game_to_cleared:
-    factor = min(LIGHT_FLASH_MAX_ENERGY, score)/LIGHT_FLASH_MAX_ENERGY
-    light_enhancement = factor*np.exp(-(t_transition/CLEAR_DELAY)*5)
-    glClearColor(light_enhancement, light_enhancement, light_enhancement, light_enhancement)
-  else:
-    glClearColor(0, 0, 0, 0)
+  glClearColor(*state.clear_color())
 
 def gl_set_viewpoint():
-  if in_transition_from_start_menu_to_game:
-    x = (VIEW_START_X-VIEW_GAME_X)*np.exp(-0.05*np.abs(VIEW_GAME_X-VIEW_START_X)*t_transition/START_GAME_DELAY)+VIEW_GAME_X
-    y = (VIEW_START_Y-VIEW_GAME_Y)*np.exp(-0.05*np.abs(VIEW_GAME_Y-VIEW_START_Y)*t_transition/START_GAME_DELAY)+VIEW_GAME_Y
-    z = (VIEW_START_Z-VIEW_GAME_Z)*np.exp(-0.05*np.abs(VIEW_GAME_Z-VIEW_START_Z)*t_transition/START_GAME_DELAY)+VIEW_GAME_Z
-    gluLookAt(x, y, z, 0.0, 0.0, 0.0, 0.0, -1, 0)
-  elif in_transition_from_game_to_cleared:
-    if t_transition < 0.5*CLEAR_DELAY:
-      gluLookAt(VIEW_GAME_X, VIEW_GAME_Y, VIEW_GAME_Z, 0.0, 0.0, 0.0, 0.0, -1, 0)
-    else:
-      t = t_transition-0.5*CLEAR_DELAY
-      x = (VIEW_GAME_X-VIEW_START_X)*np.exp(-0.1*np.abs(VIEW_START_X-VIEW_GAME_X)*t/CLEAR_DELAY)+VIEW_START_X
-      y = (VIEW_GAME_Y-VIEW_START_Y)*np.exp(-0.1*np.abs(VIEW_START_Y-VIEW_GAME_Y)*t/CLEAR_DELAY)+VIEW_START_Y
-      z = (VIEW_GAME_Z-VIEW_START_Z)*np.exp(-0.1*np.abs(VIEW_START_Z-VIEW_GAME_Z)*t/CLEAR_DELAY)+VIEW_START_Z
-      gluLookAt(x, y, z, 0.0, 0.0, 0.0, 0.0, -1, 0)
-  elif in_game or is_gameover:
-    gluLookAt(VIEW_GAME_X, VIEW_GAME_Y, VIEW_GAME_Z, 0.0, 0.0, 0.0, 0.0, -1, 0)
+  x, y, z = state.viewpoint()
+  gluLookAt(x, y, z, 0.0, 0.0, 0.0, *VIEW_UP)
+  set_view_frame([x, y, z])
+
+# --------------------------------------------------------------------------
+# Level of detail
+# --------------------------------------------------------------------------
+
+def set_view_frame(eye):
+  # camera basis matching gluLookAt towards the origin, and the projection factors used for
+  # culling and LOD; everything is kept as floats so the per-sphere checks stay cheap
+  global view_eye, view_forward, view_right, view_up
+  global view_tan_x, view_tan_y, view_pixels_per_unit
+  eye = np.array(eye, dtype=float)
+  forward = -eye/np.linalg.norm(eye)
+  right = np.cross(forward, VIEW_UP)
+  right /= np.linalg.norm(right)
+  view_eye = eye.tolist()
+  view_forward = forward.tolist()
+  view_right = right.tolist()
+  view_up = np.cross(right, forward).tolist()
+  view_tan_y = math.tan(math.radians(FIELD_OF_VIEW/2))
+  view_tan_x = view_tan_y*projection_aspect
+  # the projection aspect need not match the viewport, so spheres may be stretched; use the larger axis
+  view_pixels_per_unit = max(win.height/(2*view_tan_y), win.width/(2*view_tan_x))
+
+def view_offset(position):
+  return position[0]-view_eye[0], position[1]-view_eye[1], position[2]-view_eye[2]
+
+def dot(a, b):
+  return a[0]*b[0]+a[1]*b[1]+a[2]*b[2]
+
+def is_sphere_visible(position, size):
+  d = view_offset(position)
+  depth = dot(d, view_forward)
+  if depth+size < NEAR_CLIP or depth-size > FAR_CLIP:
+    return False
+  if abs(dot(d, view_right))-view_tan_x*depth > size*math.sqrt(1+view_tan_x**2):
+    return False
+  if abs(dot(d, view_up))-view_tan_y*depth > size*math.sqrt(1+view_tan_y**2):
+    return False
+  return True
+
+def lod_tessellation(position, size, slices, stacks, alpha=1):
+  # fewest slices keeping the silhouette within LOD_MAX_ERROR_PIXELS of a true circle;
+  # faint (blended) objects tolerate a larger error, up to LOD_MAX_FAINT_ERROR_PIXELS.
+  # Objects larger than LOD_FULL_DETAIL_RADIUS_PIXELS keep their tessellation, since
+  # per-vertex lighting (specular highlights) changes visibly with fewer facets
+  depth = max(dot(view_offset(position), view_forward), NEAR_CLIP)
+  radius = size*view_pixels_per_unit/depth
+  if radius > LOD_FULL_DETAIL_RADIUS_PIXELS:
+    return slices, stacks
+  error = min(LOD_MAX_ERROR_PIXELS/alpha, LOD_MAX_FAINT_ERROR_PIXELS)
+  if radius > error:
+    lod_slices = math.ceil(math.pi/math.acos(1-error/radius))
   else:
-    gluLookAt(VIEW_START_X, VIEW_START_Y, VIEW_START_Z, 0.0, 0.0, 0.0, 0.0, -1, 0)
+    lod_slices = LOD_MIN_SLICES
+  lod_slices = min(slices, max(LOD_MIN_SLICES, lod_slices))
+  lod_stacks = min(stacks, max(LOD_MIN_STACKS, math.ceil(stacks*lod_slices/slices)))
+  return lod_slices, lod_stacks
 
 # --------------------------------------------------------------------------
 # Create window
@@ -654,58 +913,94 @@ def on_draw():
   gl_prepare_for_2D()
   if overlay:
     overlay.draw()
-  if in_game:
-    electric_field.draw()
+  state.draw()
   gl_prepare_for_3D()
 
 @win.event
 def on_resize(width, height):
+  global projection_aspect
   glMatrixMode(GL_PROJECTION)
   glLoadIdentity()
   glViewport(0, 0, width, height)
-  gluPerspective(45, width//height, 0.1, 1000)
+  projection_aspect = width//height
+  gluPerspective(FIELD_OF_VIEW, projection_aspect, NEAR_CLIP, FAR_CLIP)
   glMatrixMode(GL_MODELVIEW)
+  request_redraw()
   return pyglet.event.EVENT_HANDLED
 
+def on_input(*args):
+  # states without a tick are redrawn only when input may have changed what is shown
+  request_redraw()
+
+for event_type in ['on_key_press', 'on_text', 'on_mouse_press', 'on_expose']:
+  win.set_handler(event_type, on_input)
+
+# --------------------------------------------------------------------------
+# Event loop
+# --------------------------------------------------------------------------
+
+class GameEventLoop(pyglet.app.EventLoop):
+  # the window is drawn only after request_redraw(), instead of pyglet's own policy
+  # (after every scheduled call in pyglet 1.x, at a fixed interval in pyglet 2.x)
+  def idle(self):
+    global is_redraw_requested
+    dt = self.clock.update_time()
+    self.clock.call_scheduled_functions(dt)
+    if is_redraw_requested:
+      is_redraw_requested = False
+      win.switch_to()
+      win.dispatch_event('on_draw')
+      win.flip()
+    return self.clock.get_sleep_time(True)
+
+def request_redraw():
+  global is_redraw_requested
+  is_redraw_requested = True
+
+def run_event_loop():
+  pyglet.app.event_loop = GameEventLoop()
+  if 'interval' in inspect.signature(pyglet.app.event_loop.run).parameters:
+    # pyglet 2.x: do not schedule the automatic redraw of all windows
+    pyglet.app.event_loop.run(None)
+  else:
+    pyglet.app.event_loop.run()
+
 # --------------------------------------------------------------------------
 # Global game state vars
 # --------------------------------------------------------------------------
 
-in_start_menu = True
-in_game = False
-in_tutorial = False
-in_transition_from_start_menu_to_game = False
+state = None
+pending_transition = None
 is_ionized = False
-is_gameover = False
-in_transition_from_game_to_cleared = False
-is_cleared = False
-
-t_transition = 0
 score = 0
 
+overlay = None
+trajectory_recorder = None
+is_redraw_requested = True
+
+projection_aspect = WINDOW_WIDTH//WINDOW_HEIGHT
+
 # --------------------------------------------------------------------------
 # Game update
 # --------------------------------------------------------------------------
 
 def update(dt):
-  global t_transition, electric_field, mesh
-  if in_game:
-    check_gameover()
-    check_collision()
-  dt_scaled = dt*TIME_SCALE_FACTOR
-  t_transition += dt
+  state.update(dt)
+  request_redraw()
+
+def update_physics(dt_scaled):
   electron_ionized.update(dt_scaled, [electric_field.ex, electric_field.ey])
   electron_localized.update(dt_scaled)
   nuclear.update()
 
-pyglet.clock.schedule_interval(update, 1/60.)
-
 # --------------------------------------------------------------------------
 # Start game
 # --------------------------------------------------------------------------
 
-overlay = StartMenu()
-set_overlay(overlay)
-init_objects()
-init_gl()
-pyglet.app.run()
+if __name__ == '__main__':
+  trajectory_recorder = TrajectoryRecorder(TRAJECTORY_DIRECTORY) if TRAJECTORY_DIRECTORY else None
+  show_start_menu()
+  init_gl()
+  run_event_loop()
+  if trajectory_recorder:
+    trajectory_recorder.close()
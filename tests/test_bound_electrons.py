@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pyglet = pytest.importorskip('pyglet')
+pyglet.options['headless'] = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main
+
+DT = 0.01
+
+# position and velocity for circular and elliptical orbits in both directions of travel
+ORBITS = {'circular': ([5, 0, 0], [0, 1/np.sqrt(5), 0]),
+          'circular_retrograde': ([0, 5, 0], [1/np.sqrt(5), 0, 0]),
+          'elliptical': ([4, 3, 0], [-0.2, 0.45, 0]),
+          'elliptical_retrograde': ([-6, 1, 0], [0.1, 0.3, 0])}
+
+
+def bound_state(electrons, t):
+  electrons.t = t
+  electrons.update(0)
+  return np.array([electrons.x, electrons.y, electrons.vx, electrons.vy])
+
+def integrate(electron, t):
+  for _ in range(int(round(t/DT))):
+    electron.update(DT, [0, 0])
+  return np.array([electron.x, electron.y, electron.vx, electron.vy])
+
+@pytest.mark.parametrize('orbit', ORBITS)
+def test_kepler_matches_rk4(orbit):
+  position, velocity = ORBITS[orbit]
+  electrons = main.Bound_electrons(1, [position], [velocity], main.ELECTRON_DRAW_PARAMS)
+  electron = main.Electron_ionized(1, list(position), list(velocity), main.ELECTRON_DRAW_PARAMS)
+  np.testing.assert_allclose(bound_state(electrons, 0)[:, 0], [position[0], position[1], velocity[0], velocity[1]],
+                             atol=1e-12)
+  np.testing.assert_allclose(bound_state(electrons, 30)[:, 0], integrate(electron, 30), atol=1e-6)
+
+def test_ionize_continues_orbit():
+  positions = [ORBITS[orbit][0] for orbit in ORBITS]
+  velocities = [ORBITS[orbit][1] for orbit in ORBITS]
+  electrons = main.Bound_electrons(1, positions, velocities, main.ELECTRON_DRAW_PARAMS)
+  reference = main.Bound_electrons(1, positions, velocities, main.ELECTRON_DRAW_PARAMS)
+  bound_state(electrons, 12)
+  electron = electrons.ionize(2)
+  assert isinstance(electron, main.Electron_ionized)
+  assert electrons.x.size == len(ORBITS)-1
+  np.testing.assert_allclose(integrate(electron, 5), bound_state(reference, 17)[:, 2], atol=1e-6)
+  np.testing.assert_allclose(bound_state(electrons, 17), np.delete(bound_state(reference, 17), 2, axis=1),
+                             atol=1e-12)
+
+@pytest.mark.parametrize('orbit', ORBITS)
+def test_scalar_and_array_paths_agree(orbit):
+  position, velocity = ORBITS[orbit]
+  single = main.Bound_electrons(1, [position], [velocity], main.ELECTRON_DRAW_PARAMS)
+  # a second, elliptical electron forces the array path with the full Kepler solve
+  ensemble = main.Bound_electrons(1, [position, ORBITS['elliptical'][0]], [velocity, ORBITS['elliptical'][1]],
+                                  main.ELECTRON_DRAW_PARAMS)
+  assert single.single_elements is not None
+  assert ensemble.single_elements is None
+  for t in [0, 3.7, 51, 400]:
+    np.testing.assert_allclose(bound_state(single, t)[:, 0], bound_state(ensemble, t)[:, 0], atol=1e-10)
+
+def test_electron_localized_keeps_circular_orbit():
+  electron = main.Electron_localized(main.ELECTRON_SIZE, main.ELECTRON_INITIAL_POSITION,
+                                     main.ELECTRON_INITIAL_VELOCITY, main.ELECTRON_DRAW_PARAMS)
+  angular_frequency = 1/np.sqrt(main.ATOM_RADIUS)**3
+  x, y, _, _ = bound_state(electron, 7.3)[:, 0]
+  np.testing.assert_allclose([x, y], [main.ATOM_RADIUS*np.cos(angular_frequency*7.3),
+                                      main.ATOM_RADIUS*np.sin(angular_frequency*7.3)], atol=1e-12)
+
+@pytest.mark.parametrize('velocity', [[0, 1, 0], [0, 0.7, 0], [0.1, 0, 0]])
+def test_unbound_or_radial_orbit_raises(velocity):
+  with pytest.raises(ValueError):
+    main.Bound_electrons(1, [[5, 0, 0]], [velocity], main.ELECTRON_DRAW_PARAMS)
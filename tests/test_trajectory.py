@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import trajectory
+
+
+def record_session(recorder, n_rows, dt=0.5):
+  recorder.start_session()
+  for i in range(n_rows):
+    recorder.record(i*dt, i, -i, 0.1*i, -0.1*i, 0.01, -0.01)
+
+def test_round_trip(tmp_path):
+  recorder = trajectory.TrajectoryRecorder(str(tmp_path), chunk_size=100)
+  record_session(recorder, 250)
+  recorder.close()
+  chunks = trajectory.load_trajectory(str(tmp_path))
+  assert [chunk.size for chunk in chunks] == [100, 100, 50]
+  for chunk in chunks:
+    assert isinstance(chunk, np.memmap)
+  x = np.concatenate([chunk['x'] for chunk in chunks])
+  np.testing.assert_array_equal(x, np.arange(250))
+  np.testing.assert_array_equal(chunks[2]['vy'], -0.1*np.arange(200, 250))
+  index = trajectory.load_index(str(tmp_path))
+  assert index.rows.tolist() == [100, 100, 50]
+  assert index.t_start.tolist() == [0, 50, 100]
+  assert index.t_end.tolist() == [49.5, 99.5, 124.5]
+
+def test_fields_are_aligned(tmp_path):
+  recorder = trajectory.TrajectoryRecorder(str(tmp_path), chunk_size=10)
+  record_session(recorder, 10)
+  recorder.close()
+  chunk = trajectory.load_trajectory(str(tmp_path))[0]
+  assert chunk['t'].flags.aligned
+
+def test_session_and_time_filters(tmp_path):
+  recorder = trajectory.TrajectoryRecorder(str(tmp_path), chunk_size=100)
+  record_session(recorder, 250)
+  record_session(recorder, 120)
+  recorder.close()
+  assert trajectory.load_index(str(tmp_path)).session.tolist() == [0, 0, 0, 1, 1]
+  assert [chunk.size for chunk in trajectory.load_trajectory(str(tmp_path), session=1)] == [100, 20]
+  chunks = trajectory.load_trajectory(str(tmp_path), session=0, t_min=40, t_max=60)
+  assert [(chunk['t'][0], chunk['t'][-1]) for chunk in chunks] == [(40, 49.5), (50, 60)]
+  chunks = trajectory.load_trajectory(str(tmp_path), t_min=110)
+  assert [(chunk['t'][0], chunk['t'][-1]) for chunk in chunks] == [(110, 124.5)]
+  assert trajectory.load_trajectory(str(tmp_path), session=2) == []
+
+def test_reopen_continues_numbering(tmp_path):
+  recorder = trajectory.TrajectoryRecorder(str(tmp_path), chunk_size=100)
+  record_session(recorder, 150)
+  recorder.close()
+  recorder = trajectory.TrajectoryRecorder(str(tmp_path), chunk_size=100)
+  record_session(recorder, 10)
+  recorder.close()
+  index = trajectory.load_index(str(tmp_path))
+  assert index.filename.tolist() == ['chunk_00000000.npy', 'chunk_00000001.npy', 'chunk_00000002.npy']
+  assert index.session.tolist() == [0, 0, 1]
+
+def test_empty_directory(tmp_path):
+  assert trajectory.load_trajectory(str(tmp_path)) == []
+  assert trajectory.load_trajectory(str(tmp_path / 'missing'), session=0, t_min=1) == []
+
+def test_record_before_start_session(tmp_path):
+  recorder = trajectory.TrajectoryRecorder(str(tmp_path))
+  with pytest.raises(RuntimeError):
+    recorder.record(0, 0, 0, 0, 0, 0, 0)
+  recorder.close()
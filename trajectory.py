@@ -0,0 +1,127 @@
+'''
+Trajectory recorder for offline analysis
+
+Recorded runs are stored as a directory of .npy chunks plus an index.csv
+listing, for every chunk, its session and time range.  Chunks are written
+while a game is running, every TRAJECTORY_CHUNK_SIZE rows (about a minute of
+frames), so at most one chunk of data is lost if the process dies.  A chunk
+never mixes sessions, so the last chunk of a session is usually shorter.
+
+Rows hold only 8-byte floats, so every field of a memory-mapped chunk is
+aligned.  load_trajectory() opens the matching chunks memory-mapped and
+returns a list with one view per chunk; time bounds are found by bisection,
+which touches only a few pages.  Nothing is copied, so ranges spanning several
+chunks should be processed chunk by chunk rather than concatenated, e.g.
+
+  import trajectory
+  for chunk in trajectory.load_trajectory('tmp/trajectory', session=3, t_min=100):
+    print(chunk['x'], chunk['vx'])
+'''
+import bisect
+import os
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+
+TRAJECTORY_DTYPE = np.dtype([('t', '<f8'),
+                             ('x', '<f8'),
+                             ('y', '<f8'),
+                             ('vx', '<f8'),
+                             ('vy', '<f8'),
+                             ('ex', '<f8'),
+                             ('ey', '<f8')])
+TRAJECTORY_CHUNK_SIZE = 4096
+TRAJECTORY_INDEX_FILENAME = 'index.csv'
+TRAJECTORY_INDEX_COLUMNS = ['filename', 'session', 't_start', 't_end', 'rows']
+
+
+class TrajectoryRecorder:
+  def __init__(self, directory, chunk_size=TRAJECTORY_CHUNK_SIZE):
+    # rows are collected in the caller's thread and written by a background thread,
+    # so record() never touches the disk
+    os.makedirs(directory, exist_ok=True)
+    self.directory = directory
+    self.chunk_size = chunk_size
+    self.index_path = os.path.join(directory, TRAJECTORY_INDEX_FILENAME)
+    if os.path.exists(self.index_path):
+      index = pd.read_csv(self.index_path)
+      self.n_chunks = index.index.size
+      self.session = int(index.session.max()) if self.n_chunks > 0 else -1
+    else:
+      self.n_chunks = 0
+      self.session = -1
+    self.is_recording = False
+    self.buffer = None
+    self.n_rows = 0
+    self.queue = queue.Queue()
+    self.writer = threading.Thread(target=self.__write_chunks, daemon=True)
+    self.writer.start()
+
+  def start_session(self):
+    self.flush()
+    self.session += 1
+    self.is_recording = True
+
+  def record(self, t, x, y, vx, vy, ex, ey):
+    if not self.is_recording:
+      raise RuntimeError('start_session() must be called before record()')
+    if self.buffer is None:
+      self.buffer = np.empty(self.chunk_size, dtype=TRAJECTORY_DTYPE)
+    self.buffer[self.n_rows] = (t, x, y, vx, vy, ex, ey)
+    self.n_rows += 1
+    if self.n_rows == self.chunk_size:
+      self.flush()
+
+  def flush(self):
+    if self.n_rows > 0:
+      self.queue.put((self.session, self.buffer[:self.n_rows]))
+      self.buffer = None
+      self.n_rows = 0
+
+  def close(self):
+    self.flush()
+    self.queue.put(None)
+    self.writer.join()
+
+  def __write_chunks(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      session, chunk = item
+      filename = 'chunk_%08d.npy' % self.n_chunks
+      np.save(os.path.join(self.directory, filename), chunk)
+      is_new_index = not os.path.exists(self.index_path)
+      with open(self.index_path, 'a') as f:
+        if is_new_index:
+          f.write(','.join(TRAJECTORY_INDEX_COLUMNS)+'\n')
+        f.write('%s,%d,%r,%r,%d\n' % (filename, session, float(chunk['t'][0]), float(chunk['t'][-1]), chunk.size))
+      self.n_chunks += 1
+
+
+def load_index(directory):
+  index_path = os.path.join(directory, TRAJECTORY_INDEX_FILENAME)
+  if os.path.exists(index_path):
+    return pd.read_csv(index_path)
+  else:
+    return pd.DataFrame(columns=TRAJECTORY_INDEX_COLUMNS)
+
+def load_trajectory(directory, session=None, t_min=None, t_max=None):
+  # returns one read-only memory-mapped view per matching chunk; nothing is copied
+  index = load_index(directory)
+  if session is not None:
+    index = index[index.session == session]
+  if t_min is not None:
+    index = index[index.t_end >= t_min]
+  if t_max is not None:
+    index = index[index.t_start <= t_max]
+  views = []
+  for filename in index.filename:
+    chunk = np.load(os.path.join(directory, filename), mmap_mode='r')
+    t = chunk['t']
+    start = 0 if t_min is None else bisect.bisect_left(t, t_min)
+    stop = chunk.size if t_max is None else bisect.bisect_right(t, t_max)
+    views.append(chunk[start:stop])
+  return views